@@ -0,0 +1,347 @@
+import logging
+import os
+import cv2
+import numpy as np
+import zxingcpp
+import deflate
+import zlib
+from gmpy2 import mpz
+import re
+import struct
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+from calendar import monthrange
+from datetime import date
+
+# QR scanning and DOB checks, run in the server's scan worker processes.
+# Kept apart from server.py so that spawning a worker doesn't also build
+# the FastAPI app and the worker pool.
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+logger = logging.getLogger(__name__)
+
+# WeChat's CNN detector with super-resolution (opencv-contrib). When its
+# models are installed it replaces the hand-tuned fallback strategies.
+# Loaded by init_worker().
+_WECHAT_MODEL_DIR = os.environ.get(
+    "WECHAT_QR_MODEL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+)
+_WECHAT_MODELS = [
+    os.path.join(_WECHAT_MODEL_DIR, name)
+    for name in ("detect.prototxt", "detect.caffemodel", "sr.prototxt", "sr.caffemodel")
+]
+_wechat = None
+
+# Same shape as a ZXing result, for payloads decoded by WeChatQRCode.
+QRResult = namedtuple("QRResult", ["bytes"])
+
+# Large photos are decoded at 1/2, 1/4 or 1/8 scale inside libjpeg's IDCT,
+# as long as the long side stays at or above _MIN_SCAN_SIDE.
+_MIN_SCAN_SIDE = 1000
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Per-thread scratch buffers for the preprocessing steps, so OpenCV writes
+# into reused memory instead of allocating a new output on every request.
+_SCRATCH = threading.local()
+
+# With an OpenCL GPU the fallback preprocessing runs on it through OpenCV's
+# Transparent API (cv2.UMat). CPU-only OpenCL runtimes don't pay off.
+# Set by init_worker().
+_USE_OPENCL = False
+
+# (epoch second, cutoff date) of the last lookup; see under_18_cutoff().
+_cutoff = (0, "")
+
+# DOB as DD-MM-YYYY (Secure QR) or YYYY-MM-DD (older XML QR), in one pass.
+_DOB_RE = re.compile(r"([0-9]{2}-[0-9]{2}-[0-9]{4}|[0-9]{4}-[0-9]{2}-[0-9]{2})")
+
+
+def decode(image):
+    """Decodes QR codes from a grayscale image using ZXing-C++."""
+    if isinstance(image, cv2.UMat):
+        image = image.get()
+    return zxingcpp.read_barcodes(image, formats=zxingcpp.BarcodeFormat.QRCode)
+
+
+def jpeg_size(buf):
+    """Reads (width, height) from a JPEG's SOF header, or None if it isn't a JPEG."""
+    if len(buf) < 4 or buf[0] != 0xFF or buf[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 <= len(buf):
+        if buf[i] != 0xFF:
+            return None
+        marker = buf[i + 1]
+        if marker == 0xFF:
+            i += 1
+        elif marker in _SOF_MARKERS:
+            height, width = struct.unpack_from(">HH", buf, i + 5)
+            return width, height
+        elif 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            i += 2
+        else:
+            i += 2 + struct.unpack_from(">H", buf, i + 2)[0]
+    return None
+
+
+def imread_flag(contents):
+    """Picks the cheapest grayscale decode that keeps enough resolution to scan."""
+    size = jpeg_size(memoryview(contents))
+    if size:
+        for factor, flag in _REDUCED_FLAGS:
+            if max(size) // factor >= _MIN_SCAN_SIDE:
+                return flag
+    return cv2.IMREAD_GRAYSCALE
+
+
+def decode_wechat(gray):
+    """Locates, rectifies and decodes QR codes with the WeChat CNN detector."""
+    texts, _ = _wechat.detectAndDecode(gray)
+    return [QRResult(text.encode("utf-8")) for text in texts if text]
+
+
+def scratch(name, shape):
+    """
+    Returns this thread's reusable uint8 buffer `name`, viewed as `shape`.
+    The buffer only grows, so varying image sizes keep reusing the same memory.
+    """
+    buffers = getattr(_SCRATCH, "buffers", None)
+    if buffers is None:
+        buffers = _SCRATCH.buffers = {}
+    size = shape[0] * shape[1]
+    buf = buffers.get(name)
+    if buf is None or buf.size < size:
+        buf = buffers[name] = np.empty(size, np.uint8)
+    return buf[:size].reshape(shape)
+
+
+def to_device(gray):
+    """Uploads the plane for the fallback strategies; a no-op without an OpenCL GPU."""
+    return cv2.UMat(gray) if _USE_OPENCL else gray
+
+
+def output(name, shape):
+    """Destination for a preprocessing step: a scratch buffer, or a new UMat on the GPU."""
+    return None if _USE_OPENCL else scratch(name, shape)
+
+
+def scan_sharpened(gray):
+    """Unsharp mask for blurry photos."""
+    # Two 7x7 box passes approximate the sigma=3 Gaussian at O(1) cost per
+    # pixel, and all three steps reuse a single buffer.
+    src = to_device(gray)
+    blurred = cv2.blur(src, (7, 7), dst=output("sharpened", gray.shape))
+    cv2.blur(blurred, (7, 7), dst=blurred)
+    sharpened = cv2.addWeighted(src, 1.5, blurred, -0.5, 0, dst=blurred)
+    return decode(sharpened)
+
+
+def scan_high_contrast(gray):
+    """Binarises the image to cut through glare and shadows."""
+    # A local mean threshold follows uneven lighting; a global Otsu cut does not.
+    binary = cv2.adaptiveThreshold(to_device(gray), 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 31, 7,
+                                   dst=output("binary", gray.shape))
+    return decode(binary)
+
+
+# ZXing already retries each plane at 90 degree turns (try_rotate), so no
+# separate rotated pass is needed.
+FALLBACK_STRATEGIES = (scan_sharpened, scan_high_contrast)
+
+# Runs the fallback strategies side by side, one thread each.
+# ZXing-C++ and OpenCV release the GIL, so the threads run in parallel.
+# Created by init_worker().
+_POOL = None
+
+
+def init_worker():
+    """
+    Sets up a scan worker process before its first task. The server process
+    imports this module too, so nothing heavy is created at import time.
+    """
+    global _wechat, _USE_OPENCL, _POOL
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    # The parallelism comes from the worker processes themselves.
+    cv2.setNumThreads(1)
+    if hasattr(cv2, "wechat_qrcode") and all(map(os.path.exists, _WECHAT_MODELS)):
+        _wechat = cv2.wechat_qrcode.WeChatQRCode(*_WECHAT_MODELS)
+    else:
+        logger.info("WeChat QR models not found, using the classic fallback strategies.")
+    _USE_OPENCL = cv2.ocl.haveOpenCL() and bool(cv2.ocl.Device.getDefault().type() & cv2.ocl.DEVICE_TYPE_GPU)
+    _POOL = ThreadPoolExecutor(max_workers=len(FALLBACK_STRATEGIES), thread_name_prefix="smart-scan")
+
+
+def warm_up():
+    """Runs every strategy once on a blank image so the worker is ready for real uploads."""
+    blank = np.full((64, 64), 255, np.uint8)
+    decode(blank)
+    if _wechat is not None:
+        decode_wechat(blank)
+
+    # The fallbacks run on _POOL's threads, each with its own scratch
+    # buffers. The barrier holds every task until all of them have started,
+    # so each one gets a thread of its own and warms all the strategies there.
+    started = threading.Barrier(len(FALLBACK_STRATEGIES))
+
+    def warm_thread():
+        started.wait()
+        for strategy in FALLBACK_STRATEGIES:
+            strategy(blank)
+
+    for future in [_POOL.submit(warm_thread) for _ in FALLBACK_STRATEGIES]:
+        future.result()
+
+
+def scan_plane(gray):
+    """
+    Scans a grayscale plane using multiple strategies (Standard, then WeChat
+    CNN if installed, else Sharpened and Contrast).
+    """
+    # 1. Standard
+    decoded = decode(gray)
+    if decoded: return decoded
+
+    # 2. One CNN pass finds and rectifies codes the filters below would
+    # only catch by luck, so it replaces them when available.
+    if _wechat is not None:
+        return decode_wechat(gray)
+
+    # 2-3. Classic fallbacks, run concurrently; the first one that decodes wins.
+    futures = [_POOL.submit(strategy, gray) for strategy in FALLBACK_STRATEGIES]
+    try:
+        for future in as_completed(futures):
+            decoded = future.result()
+            if decoded: return decoded
+    finally:
+        for future in futures:
+            future.cancel()
+
+    return None
+
+
+def smart_scan(contents):
+    """
+    Decodes the upload to grayscale and scans it, at a reduced scale for
+    large JPEGs. If that finds nothing, the plain decode is retried at full
+    resolution.
+    """
+    try:
+        img_array = np.frombuffer(contents, np.uint8)
+
+        # Every strategy works on a single channel, so let the JPEG decoder
+        # emit grayscale directly instead of converting from BGR per strategy.
+        flag = imread_flag(contents)
+        gray = cv2.imdecode(img_array, flag)
+        if gray is None:
+            return None
+
+        decoded = scan_plane(gray)
+        if decoded: return decoded
+
+        # The reduction only looks at the frame size; a QR code covering a
+        # small part of a large photo may need every pixel. Only the plain
+        # decode is retried, so a photo without a code stays cheaper than one
+        # full-resolution sweep.
+        if flag != cv2.IMREAD_GRAYSCALE:
+            del gray
+            decoded = decode(cv2.imdecode(img_array, cv2.IMREAD_GRAYSCALE))
+            if decoded: return decoded
+
+        return None
+    except Exception:
+        return None
+
+def under_18_cutoff():
+    """Returns the date 18 years before today as YYYY-MM-DD, looked up at most once a second."""
+    global _cutoff
+    now = int(time.time())
+    if now != _cutoff[0]:
+        today = date.today()
+        _cutoff = (now, "%04d-%02d-%02d" % (today.year - 18, today.month, today.day))
+    return _cutoff[1]
+
+
+def is_under_18(dob_string):
+    """
+    Compares the DOB, normalised to YYYY-MM-DD, against the cutoff as strings;
+    anyone born after it has not turned 18 yet. An unreadable or impossible
+    DOB (e.g. 31-02) counts as under 18, as it did when the age fell back to 0.
+    """
+    if len(dob_string) != 10:
+        return True
+    if dob_string[4] == "-":
+        dob = dob_string
+    elif dob_string[2] in "-/":
+        dob = "%s-%s-%s" % (dob_string[6:10], dob_string[3:5], dob_string[0:2])
+    else:
+        return True
+
+    try:
+        year, month, day = int(dob[:4]), int(dob[5:7]), int(dob[8:10])
+    except ValueError:
+        return True
+    if not (year >= 1 and 1 <= month <= 12 and 1 <= day <= monthrange(year, month)[1]):
+        return True
+
+    return dob > under_18_cutoff()
+
+def decode_secure_qr(data_bytes):
+    """Decodes Aadhaar Secure QR data."""
+    try:
+        # The payload is a base-10 integer hundreds of digits long. GMP converts
+        # it subquadratically; CPython's int() parse is quadratic.
+        big_int = mpz(data_bytes)
+        byte_len = (big_int.bit_length() + 7) // 8
+        binary_data = bytes.fromhex(big_int.digits(16).zfill(byte_len * 2))
+        # libdeflate sizes its output from the gzip trailer, so bytes after the
+        # stream make it return an empty result or fail. zlib stops at the end
+        # of the stream and ignores them.
+        try:
+            decompressed = deflate.gzip_decompress(binary_data)
+        except deflate.DeflateError:
+            decompressed = None
+        if not decompressed:
+            decompressed = zlib.decompress(binary_data, 16 + zlib.MAX_WBITS)
+        return decompressed.decode("latin-1")
+    except:
+        return data_bytes.decode("utf-8")
+
+
+def verify_image(contents):
+    """Scans an uploaded image and builds the verification response. Runs in a worker process."""
+    decoded_objects = smart_scan(contents)
+
+    if not decoded_objects:
+        logger.warning("Verification failed: No valid QR code detected.")
+        return {"success": False, "message": "No QR code detected."}
+
+    for obj in decoded_objects:
+        try:
+            text_data = decode_secure_qr(obj.bytes)
+            
+            match = _DOB_RE.search(text_data)
+
+            if match:
+                dob = match.group(1)
+                under_18 = is_under_18(dob)
+                
+                logger.info("QR decoded successfully. Age checked internally.")
+
+                return {
+                    "success": True, 
+                    "is_under_18": under_18
+                }
+            
+        except Exception:
+            logger.error("Error parsing QR data structure.")
+            continue
+
+    logger.info("Verification failed: QR found but DOB unreadable.")
+    return {"success": False, "message": "Could not verify age from this QR."}
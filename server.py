@@ -1,27 +1,44 @@
 import logging
+import os
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-import cv2
-import numpy as np
-from pyzbar.pyzbar import decode
-import zlib
-import re
-from datetime import datetime
+import xxhash
+import threading
+import asyncio
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+
+from scanner import LOG_FORMAT, init_worker, under_18_cutoff, verify_image, warm_up
 
 # --- PRIVACY & SECURITY NOTICE ---
 # This application is designed to be stateless and privacy-preserving.
 # No images are written to the disk (processed in RAM only).
 # No personal data (Name, DOB, Aadhaar Number) is logged or stored in a database.
 # The API response returns only a boolean validation flag, not the user's specific age or DOB.
+# Recent results are kept in memory under a hash of the upload, so that
+# retries and double submits skip the scan. Only that flag is cached.
 # ---------------------------------
 
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
+    format=LOG_FORMAT
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    """Spawns and warms the scan workers before the first request arrives."""
+    global _PROCESS_POOL
+    _PROCESS_POOL = new_process_pool()
+    await warm_workers(_PROCESS_POOL)
+    yield
+    _PROCESS_POOL.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan)
 
 # --- HEALTH CHECK ---
 @app.get("/")
@@ -35,124 +52,141 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-
-def smart_scan(img_array):
-    """
-    Scans the image using multiple strategies (Standard, Sharpened, Contrast, Rotated).
-    """
+# Each upload is scanned in one of these worker processes, so the Python
+# parts of the pipeline don't serialise on the server's GIL. Workers are
+# spawned rather than forked; forking a process that already runs OpenCV's
+# and the event loop's threads can deadlock the child.
+#
+# The pool is sized from the CPUs this process may actually run on (or the
+# SCAN_WORKERS env var), not os.cpu_count(), which ignores affinity masks and
+# container quotas. Each worker keeps OpenCV single-threaded, since the
+# parallelism comes from the workers themselves. The scanning code lives in
+# scanner.py, so a spawned worker imports only what it runs.
+_SPAWN = multiprocessing.get_context("spawn")
+
+
+def available_cpus():
+    """Counts the CPUs this process is allowed to run on."""
     try:
-        img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-        
-        if img is None:
-            return None
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
 
-        def try_decode(image):
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            return decode(gray)
-        
-        decoded = try_decode(img)
-        if decoded: return decoded
-
-        gaussian = cv2.GaussianBlur(img, (0, 0), 3)
-        sharpened = cv2.addWeighted(img, 1.5, gaussian, -0.5, 0)
-        decoded = try_decode(sharpened)
-        if decoded: return decoded
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        _, binary = cv2.threshold(gray, 128, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
-        decoded = decode(binary)
-        if decoded: return decoded
-
-        # 4. Rotated
-        rotated = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
-        decoded = try_decode(rotated)
-        if decoded: return decoded
-
-        return None
-    except Exception:
-        return None
 
-def calculate_exact_age(dob_string):
-    """Calculates age accurately down to the specific day."""
-    try:
-        if "-" in dob_string:
-            parts = dob_string.split("-")
-            if len(parts[0]) == 4:
-                year, month, day = map(int, parts)
-            else: 
-                day, month, year = map(int, parts)
-        elif "/" in dob_string:
-            day, month, year = map(int, dob_string.split("/"))
-        
-        birth_date = datetime(year, month, day)
-        today = datetime.now()
-        
-        age = today.year - birth_date.year
-        if (today.month, today.day) < (birth_date.month, birth_date.day):
-            age -= 1
-            
-        return age
-    except:
-        return 0
-
-def decode_secure_qr(data_bytes):
-    """Decodes Aadhaar Secure QR data."""
+_WORKERS = int(os.environ.get("SCAN_WORKERS", 0)) or available_cpus()
+
+
+def new_process_pool():
+    """Creates a scan worker pool. Its processes start on first use."""
+    return ProcessPoolExecutor(max_workers=_WORKERS, mp_context=_SPAWN, initializer=init_worker)
+
+
+# Created by lifespan(), so that only the server process has one.
+_PROCESS_POOL = None
+
+# Background warm-ups of replacement pools, referenced until they finish.
+_WARM_UPS = set()
+
+# LRU of response dicts keyed by the xxh3-128 digest of the upload and the
+# under-18 cutoff date, so yesterday's answers stop matching at midnight.
+_CACHE = OrderedDict()
+_CACHE_SIZE = 1024
+_CACHE_LOCK = threading.Lock()
+
+
+def cache_key(digest):
+    """Key for an upload: is_under_18 depends on the day as well as the image."""
+    return (under_18_cutoff(), digest)
+
+
+def cached_result(key):
+    """Returns the cached response for an upload, if any."""
+    with _CACHE_LOCK:
+        result = _CACHE.get(key)
+        if result is not None:
+            _CACHE.move_to_end(key)
+        return result
+
+
+def cache_result(key, result):
+    """Stores a response, evicting the least recently used one when full."""
+    with _CACHE_LOCK:
+        _CACHE[key] = result
+        _CACHE.move_to_end(key)
+        if len(_CACHE) > _CACHE_SIZE:
+            _CACHE.popitem(last=False)
+
+
+async def warm_workers(pool):
+    """Runs warm_up once per worker slot, which also starts every worker process."""
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(pool, warm_up) for _ in range(_WORKERS)))
+
+
+def warm_in_background(pool):
+    """Warms a replacement pool without holding up the request that broke the old one."""
+    task = asyncio.create_task(warm_workers(pool))
+    _WARM_UPS.add(task)
+    task.add_done_callback(warm_up_done)
+
+
+def warm_up_done(task):
+    """Drops a finished warm-up and logs it if it failed."""
+    _WARM_UPS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Warming the replacement scan workers failed.")
+
+
+async def scan_upload(contents):
+    """
+    Runs verify_image in the worker pool. If a worker dies, the pool is
+    replaced (once, by whichever request notices first) and the job is
+    submitted again to the new pool.
+    """
+    global _PROCESS_POOL
+    loop = asyncio.get_running_loop()
+    pool = _PROCESS_POOL
     try:
-        big_int = int(data_bytes.decode("utf-8"))
-        byte_len = (big_int.bit_length() + 7) // 8
-        binary_data = big_int.to_bytes(byte_len, byteorder='big')
-        decompressed = zlib.decompress(binary_data, 16+zlib.MAX_WBITS)
-        return decompressed.decode("latin-1")
-    except:
-        return data_bytes.decode("utf-8")
+        return await loop.run_in_executor(pool, verify_image, contents)
+    except BrokenProcessPool:
+        if pool is _PROCESS_POOL:
+            logger.error("Scan worker died, restarting the process pool.")
+            _PROCESS_POOL = new_process_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+            warm_in_background(_PROCESS_POOL)
+    return await loop.run_in_executor(_PROCESS_POOL, verify_image, contents)
 
 
 @app.post("/verify")
-def verify_aadhaar(file: UploadFile = File(...)):
+async def verify_aadhaar(file: UploadFile = File(...)):
     """
     Verifies age from Aadhaar QR.
-    Note: Synchronous definition (no 'async') ensures OpenCV runs in a 
-    threadpool to prevent server blocking.
+    Note: The scan itself runs in the worker process pool, so OpenCV never
+    blocks the event loop.
     """
     try:
         logger.info("New verification request received.")
         
-        contents = file.file.read()
-        nparr = np.frombuffer(contents, np.uint8)
-
-        decoded_objects = smart_scan(nparr)
+        # One read, through UploadFile's public API (it moves reads from a
+        # spooled temporary file off the event loop). The same bytes are
+        # hashed and handed to the worker.
+        contents = await file.read()
+        key = cache_key(xxhash.xxh3_128_digest(contents))
+        result = cached_result(key)
+        if result is not None:
+            logger.info("Duplicate upload, returning cached result.")
+            return dict(result)
+
+        result = await scan_upload(contents)
 
         del contents
-        del nparr
-
-        if not decoded_objects:
-            logger.warning("Verification failed: No valid QR code detected.")
-            return {"success": False, "message": "No QR code detected."}
-
-        for obj in decoded_objects:
-            try:
-                text_data = decode_secure_qr(obj.data)
-                
-                match = re.search(r"([0-9]{2}-[0-9]{2}-[0-9]{4})", text_data)
-                if not match:
-                    match = re.search(r"([0-9]{4}-[0-9]{2}-[0-9]{2})", text_data)
-
-                if match:
-                    dob = match.group(1)
-                    age = calculate_exact_age(dob)
-                    
-                    logger.info("QR decoded successfully. Age calculated internally.")
-
-                    return {
-                        "success": True, 
-                        "is_under_18": age < 18
-                    }
-                
-            except Exception:
-                logger.error("Error parsing QR data structure.")
-                continue
-
-        logger.info("Verification failed: QR found but DOB unreadable.")
-        return {"success": False, "message": "Could not verify age from this QR."}
+
+        cache_result(key, result)
+        return dict(result)
+
+    except BrokenProcessPool:
+        logger.error("Scan worker died again on retry.")
+        return {"success": False, "message": "Internal processing error."}
 
     except Exception:
         logger.error("Internal server error during verification.")